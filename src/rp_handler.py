@@ -1,27 +1,104 @@
 import runpod
 from runpod.serverless.utils import rp_upload
 import json
-import urllib.request
-import urllib.parse
+import orjson
+import logging
+import logging.handlers
+import queue
+import atexit
 import time
 import os
+import random
+import psutil
 import requests
 import base64
-from io import BytesIO
-
-# Time to wait between API check attempts in milliseconds
-COMFY_API_AVAILABLE_INTERVAL_MS = 50
+import binascii
+import mimetypes
+import uuid
+import asyncio
+import aiohttp
+from boto3.s3.transfer import TransferConfig
+
+# Time to wait before the first API check retry in milliseconds
+COMFY_API_AVAILABLE_INTERVAL_MS = 10
+# Upper bound for the growing time between API check attempts in milliseconds
+COMFY_API_AVAILABLE_MAX_INTERVAL_MS = 500
 # Maximum number of API check attempts
 COMFY_API_AVAILABLE_MAX_RETRIES = 500
-# Time to wait between poll attempts in milliseconds (30 seconds)
+# Maximum time to wait for the API in milliseconds, whichever limit is hit first
+COMFY_API_AVAILABLE_TIMEOUT_MS = 25000
+# Time to wait before the first poll attempt in milliseconds
+COMFY_POLLING_INITIAL_INTERVAL_MS = 500
+# Upper bound for the growing time between poll attempts in milliseconds (30 seconds)
 COMFY_POLLING_INTERVAL_MS = int(os.environ.get("COMFY_POLLING_INTERVAL_MS", 30000))
-# Maximum number of poll attempts (120 retries × 30 seconds = 1 hour)
+# Maximum number of poll attempts (120 retries × 30 seconds = 1 hour),
+# together with the interval this is the time we wait for a workflow to finish
 COMFY_POLLING_MAX_RETRIES = int(os.environ.get("COMFY_POLLING_MAX_RETRIES", 120))
 # Host where ComfyUI is running
 COMFY_HOST = "127.0.0.1:8188"
+# Time in seconds to wait for a connection to or data from ComfyUI (or an image URL)
+COMFY_REQUEST_TIMEOUT_S = 30
+# The websocket is idle while a node runs and uploads can take longer than the
+# read timeout, so only the other HTTP requests get one
+COMFY_CONNECT_TIMEOUT = aiohttp.ClientTimeout(sock_connect=COMFY_REQUEST_TIMEOUT_S)
+COMFY_REQUEST_TIMEOUT = aiohttp.ClientTimeout(
+    sock_connect=COMFY_REQUEST_TIMEOUT_S, sock_read=COMFY_REQUEST_TIMEOUT_S
+)
+# Folder where ComfyUI writes the generated files
+COMFY_OUTPUT_PATH = os.environ.get("COMFY_OUTPUT_PATH", "/comfyui/output")
 # Enforce a clean state after each job is done
 # see https://docs.runpod.io/docs/handler-additional-controls#refresh-worker
 REFRESH_WORKER = os.environ.get("REFRESH_WORKER", "false").lower() == "true"
+# Also refresh the worker when the system memory usage (in percent) is above
+# this value, 0 disables the check. This is the memory of the whole host as
+# reported by psutil, not the memory limit of the container
+REFRESH_WORKER_MEMORY_THRESHOLD = float(os.environ.get("REFRESH_WORKER_MEMORY_THRESHOLD", 0))
+# Maximum length of a base64 encoded input image (128 MB)
+MAX_IMAGE_B64 = int(os.environ.get("MAX_IMAGE_B64", 128 * 1024 * 1024))
+# Size of the base64 windows that are decoded at once (must be a multiple of 4)
+BASE64_DECODE_CHUNK_SIZE = 64 * 1024
+# Size of the blocks that are base64 encoded at once (must be a multiple of 3)
+BASE64_ENCODE_CHUNK_SIZE = 48 * 1024
+
+# Keys an entry in 'images' needs, either with the data or with a URL
+IMAGE_BASE64_KEYS = frozenset(("name", "image"))
+IMAGE_URL_KEYS = frozenset(("name", "url"))
+
+# Log level of the worker, set it to DEBUG to get details about the outputs
+COMFY_LOG_LEVEL = os.environ.get("COMFY_LOG_LEVEL", "INFO").upper()
+if not isinstance(logging.getLevelName(COMFY_LOG_LEVEL), int):
+    COMFY_LOG_LEVEL = "INFO"
+
+log = logging.getLogger("runpod-worker-comfy")
+log.setLevel(COMFY_LOG_LEVEL)
+log.propagate = False
+# The module can be imported more than once, only add the handler the first time
+if not log.handlers:
+    # Records are written by a background thread, so logging never blocks a job
+    _log_queue = queue.SimpleQueue()
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("%(name)s - %(message)s"))
+    _log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+    log.addHandler(logging.handlers.QueueHandler(_log_queue))
+
+# Set once the ComfyUI API has been reachable, ComfyUI runs for the whole
+# lifetime of the container
+_server_ready = False
+
+# S3 client for the output files, configured by the same BUCKET_* environment
+# variables as rp_upload (None if those are not set)
+S3_CLIENT, _ = rp_upload.get_boto_client()
+# Upload big outputs (e.g. videos) in 8 MB parts with several parts in flight
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=8,
+    use_threads=True,
+)
+# Time in seconds the presigned URL of an uploaded output file is valid (7 days)
+S3_PRESIGNED_URL_EXPIRES_IN = 604800
 
 
 def validate_input(job_input):
@@ -55,61 +132,211 @@ def validate_input(job_input):
     images = job_input.get("images")
     if images is not None:
         if not isinstance(images, list) or not all(
-            "name" in image and "image" in image for image in images
+            isinstance(image, dict)
+            and (IMAGE_BASE64_KEYS.issubset(image) or IMAGE_URL_KEYS.issubset(image))
+            for image in images
         ):
             return (
                 None,
-                "'images' must be a list of objects with 'name' and 'image' keys",
+                "'images' must be a list of objects with 'name' and 'image' or 'url' keys",
             )
 
+        for image in images:
+            name = image["name"]
+            if not isinstance(name, str) or not name:
+                return None, "'name' of every image must be a non-empty string"
+            if "url" in image:
+                if not isinstance(image["url"], str) or not image["url"]:
+                    return None, f"'url' of '{name}' must be a non-empty string"
+                continue
+
+            # Catch oversized or broken base64 strings before they are decoded,
+            # the size is checked first as it doesn't have to scan the string.
+            # Whitespace (e.g. line-wrapped base64) is skipped when decoding
+            data = image["image"]
+            if not isinstance(data, str):
+                return None, f"'image' of '{name}' is not a valid base64 string"
+            if len(data) > MAX_IMAGE_B64:
+                return (
+                    None,
+                    f"'image' of '{name}' exceeds the maximum size of {MAX_IMAGE_B64} characters",
+                )
+            if len(data) % 4 and (len(data) - sum(map(data.count, " \t\r\n"))) % 4:
+                return None, f"'image' of '{name}' is not a valid base64 string"
+
+    # Validate 'refresh_worker' in input, if provided
+    refresh_worker = job_input.get("refresh_worker")
+    if refresh_worker is not None and not isinstance(refresh_worker, bool):
+        return None, "'refresh_worker' must be a boolean"
+
     # Return validated data and no error
-    return {"workflow": workflow, "images": images}, None
+    return {
+        "workflow": workflow,
+        "images": images,
+        "refresh_worker": refresh_worker,
+    }, None
 
 
-def check_server(url, retries=500, delay=50):
+def check_server(url, retries=500, delay=10, max_delay=500, timeout=25000):
     """
     Check if a server is reachable via HTTP GET request
 
     Args:
     - url (str): The URL to check
-    - retries (int, optional): The number of times to attempt connecting to the server. Default is 50
-    - delay (int, optional): The time in milliseconds to wait between retries. Default is 500
+    - retries (int, optional): The number of times to attempt connecting to the server. Default is 500
+    - delay (int, optional): The time in milliseconds to wait before the first retry, it grows by 1.5x per retry. Default is 10
+    - max_delay (int, optional): The maximum time in milliseconds to wait between retries. Default is 500
+    - timeout (int, optional): The maximum time in milliseconds to wait in total. Default is 25000
 
     Returns:
-    bool: True if the server is reachable within the given number of retries, otherwise False
+    bool: True if the server is reachable within the given number of retries and time, otherwise False
     """
+    deadline = time.monotonic() + timeout / 1000
+    attempt = 0
 
-    for i in range(retries):
+    for attempt in range(1, retries + 1):
         try:
-            response = requests.get(url)
+            response = requests.get(url, timeout=2)
 
             # If the response status code is 200, the server is up and running
             if response.status_code == 200:
-                print(f"runpod-worker-comfy - API is reachable")
+                log.info("API is reachable")
                 return True
         except requests.RequestException as e:
             # If an exception occurs, the server may not be ready
             pass
 
-        # Wait for the specified delay before retrying
-        time.sleep(delay / 1000)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
 
-    print(
-        f"runpod-worker-comfy - Failed to connect to server at {url} after {retries} attempts."
-    )
+        # Back off exponentially (with a bit of jitter) before retrying
+        time.sleep(min((delay + random.uniform(0, delay * 0.1)) / 1000, remaining))
+        delay = min(delay * 1.5, max_delay)
+
+    log.error("Failed to connect to server at %s after %s attempts.", url, attempt)
     return False
 
 
-def upload_images(images):
+async def _decode_base64_chunks(data):
+    """
+    Decode a base64 encoded string chunk by chunk.
+
+    Whitespace (e.g. line-wrapped base64) is skipped, and characters are carried
+    over so every chunk is decoded on a boundary of 4-character groups.
+
+    Args:
+        data (str): The base64 encoded string
+
+    Yields:
+        bytes: The next decoded chunk
+    """
+    rest = ""
+    for start in range(0, len(data), BASE64_DECODE_CHUNK_SIZE):
+        chunk = rest + "".join(data[start : start + BASE64_DECODE_CHUNK_SIZE].split())
+        end = len(chunk) - len(chunk) % 4
+        rest = chunk[end:]
+        if end:
+            yield base64.b64decode(chunk[:end])
+    if rest:
+        # Let b64decode raise for the incomplete trailing group
+        yield base64.b64decode(rest)
+
+
+async def _upload_image(session, image):
+    """
+    Upload a single image to the ComfyUI server.
+
+    Images given by 'url' are streamed from the source straight into the upload,
+    images given as base64 encoded 'image' are decoded while they are sent.
+
+    Args:
+        session (aiohttp.ClientSession): The session of the job
+        image (dict): A dictionary containing the 'name' of the image and either the 'url' of the image or the 'image' as a base64 encoded string.
+
+    Returns:
+        tuple: A tuple (name, ok, message) describing the outcome of the upload.
+    """
+    name = image["name"]
+
+    try:
+        if "url" in image:
+            async with session.get(
+                image["url"], timeout=COMFY_REQUEST_TIMEOUT
+            ) as source:
+                source.raise_for_status()
+                status, text = await _post_image(session, name, source.content)
+        else:
+            status, text = await _post_image(
+                session, name, _decode_base64_chunks(image["image"])
+            )
+    except (aiohttp.ClientError, binascii.Error) as e:
+        return name, False, f"Error uploading {name}: {str(e)}"
+
+    if status != 200:
+        return name, False, f"Error uploading {name}: {text}"
+
+    return name, True, f"Successfully uploaded {name}"
+
+
+async def _post_image(session, name, data):
+    """
+    POST image data to the /upload/image endpoint of ComfyUI.
+
+    Args:
+        session (aiohttp.ClientSession): The session of the job
+        name (str): The name under which the image is stored in ComfyUI
+        data (aiohttp.StreamReader or async iterable): The image data
+
+    Returns:
+        tuple: The status code and the text of the response from ComfyUI
+    """
+    # ComfyUI only reads the first "image" part of the form and still answers
+    # with 200, so images can't be batched into one request without silently
+    # losing all but the first one
+    form = aiohttp.FormData()
+    form.add_field("image", data, filename=name, content_type="image/png")
+    form.add_field("overwrite", "true")
+
+    # aiohttp starts the read timeout before the body is sent, so a long (but
+    # flowing) upload would time out. A stalled URL source is still caught by
+    # the read timeout of its own request
+    async with session.post(
+        f"http://{COMFY_HOST}/upload/image", data=form, timeout=COMFY_CONNECT_TIMEOUT
+    ) as response:
+        return response.status, await response.text()
+
+
+def wait_for_server():
+    """
+    Wait until the ComfyUI API is available and remember the result
+
+    Returns:
+        bool: True if the ComfyUI API is available, otherwise False
+    """
+    global _server_ready
+    _server_ready = check_server(
+        f"http://{COMFY_HOST}",
+        COMFY_API_AVAILABLE_MAX_RETRIES,
+        COMFY_API_AVAILABLE_INTERVAL_MS,
+        COMFY_API_AVAILABLE_MAX_INTERVAL_MS,
+        COMFY_API_AVAILABLE_TIMEOUT_MS,
+    )
+    return _server_ready
+
+
+async def upload_images(session, images):
     """
     Upload a list of base64 encoded images to the ComfyUI server using the /upload/image endpoint.
 
+    All uploads run concurrently.
+
     Args:
-        images (list): A list of dictionaries, each containing the 'name' of the image and the 'image' as a base64 encoded string.
-        server_address (str): The address of the ComfyUI server.
+        session (aiohttp.ClientSession): The session of the job
+        images (list): A list of dictionaries, each containing the 'name' of the image and either the 'url' of the image or the 'image' as a base64 encoded string.
 
     Returns:
-        list: A list of responses from the server for each image upload.
+        dict: The status of the upload and the responses from the server for each image upload.
     """
     if not images:
         return {"status": "success", "message": "No images to upload", "details": []}
@@ -117,35 +344,25 @@ def upload_images(images):
     responses = []
     upload_errors = []
 
-    print(f"runpod-worker-comfy - image(s) upload")
+    log.info("image(s) upload")
 
-    for image in images:
-        name = image["name"]
-        image_data = image["image"]
-        blob = base64.b64decode(image_data)
+    results = await asyncio.gather(*[_upload_image(session, image) for image in images])
 
-        # Prepare the form data
-        files = {
-            "image": (name, BytesIO(blob), "image/png"),
-            "overwrite": (None, "true"),
-        }
-
-        # POST request to upload the image
-        response = requests.post(f"http://{COMFY_HOST}/upload/image", files=files)
-        if response.status_code != 200:
-            upload_errors.append(f"Error uploading {name}: {response.text}")
+    for name, ok, message in results:
+        if ok:
+            responses.append(message)
         else:
-            responses.append(f"Successfully uploaded {name}")
+            upload_errors.append(message)
 
     if upload_errors:
-        print(f"runpod-worker-comfy - image(s) upload with errors")
+        log.error("image(s) upload with errors")
         return {
             "status": "error",
             "message": "Some images failed to upload",
             "details": upload_errors,
         }
 
-    print(f"runpod-worker-comfy - image(s) upload complete")
+    log.info("image(s) upload complete")
     return {
         "status": "success",
         "message": "All images uploaded successfully",
@@ -153,36 +370,157 @@ def upload_images(images):
     }
 
 
-def queue_workflow(workflow):
+async def connect_websocket(session, client_id):
+    """
+    Open a websocket to ComfyUI that receives the execution events of a client
+
+    Args:
+        session (aiohttp.ClientSession): The session of the job
+        client_id (str): The ID of the client, the same ID has to be used when queueing
+
+    Returns:
+        aiohttp.ClientWebSocketResponse: The connected websocket
+
+    Raises:
+        ConnectionError: If the handshake doesn't finish within COMFY_REQUEST_TIMEOUT_S
+    """
+    # The session has no read timeout, so the handshake is bounded here. Big
+    # preview frames or outputs must not break the connection, so the message
+    # size isn't limited
+    try:
+        return await asyncio.wait_for(
+            session.ws_connect(
+                f"ws://{COMFY_HOST}/ws?clientId={client_id}", max_msg_size=0
+            ),
+            COMFY_REQUEST_TIMEOUT_S,
+        )
+    except asyncio.TimeoutError:
+        raise ConnectionError(
+            f"No handshake within {COMFY_REQUEST_TIMEOUT_S} seconds"
+        ) from None
+
+
+async def queue_workflow(session, workflow, client_id=None):
     """
     Queue a workflow to be processed by ComfyUI
 
     Args:
+        session (aiohttp.ClientSession): The session of the job
         workflow (dict): A dictionary containing the workflow to be processed
+        client_id (str, optional): The websocket client that should receive the execution events
 
     Returns:
         dict: The JSON response from ComfyUI after processing the workflow
     """
 
     # The top level element "prompt" is required by ComfyUI
-    data = json.dumps({"prompt": workflow}).encode("utf-8")
-
-    req = urllib.request.Request(f"http://{COMFY_HOST}/prompt", data=data)
-    return json.loads(urllib.request.urlopen(req).read())
-
-
-def get_history(prompt_id):
+    payload = {"prompt": workflow}
+    if client_id is not None:
+        payload["client_id"] = client_id
+    data = orjson.dumps(payload)
+
+    async with session.post(
+        f"http://{COMFY_HOST}/prompt",
+        data=data,
+        headers={"Content-Type": "application/json"},
+        timeout=COMFY_REQUEST_TIMEOUT,
+    ) as response:
+        response.raise_for_status()
+        return orjson.loads(await response.read())
+
+
+async def get_history(session, prompt_id):
     """
     Retrieve the history of a given prompt using its ID
 
     Args:
+        session (aiohttp.ClientSession): The session of the job
         prompt_id (str): The ID of the prompt whose history is to be retrieved
 
     Returns:
         dict: The history of the prompt, containing all the processing steps and results
     """
-    with urllib.request.urlopen(f"http://{COMFY_HOST}/history/{prompt_id}") as response:
-        return json.loads(response.read())
+    async with session.get(
+        f"http://{COMFY_HOST}/history/{prompt_id}", timeout=COMFY_REQUEST_TIMEOUT
+    ) as response:
+        response.raise_for_status()
+        return orjson.loads(await response.read())
+
+
+async def queue_contains(session, prompt_id):
+    """
+    Check if a prompt is still running or waiting in the queue of ComfyUI
+
+    Args:
+        session (aiohttp.ClientSession): The session of the job
+        prompt_id (str): The ID of the prompt to look for
+
+    Returns:
+        bool: True if the prompt is running or pending, otherwise False
+    """
+    async with session.get(
+        f"http://{COMFY_HOST}/queue", timeout=COMFY_REQUEST_TIMEOUT
+    ) as response:
+        response.raise_for_status()
+        queue_state = orjson.loads(await response.read())
+
+    items = queue_state.get("queue_running", []) + queue_state.get("queue_pending", [])
+    # Every queue item is a list of [number, prompt_id, prompt, extra_data, outputs]
+    return any(item[1] == prompt_id for item in items)
+
+
+async def wait_for_prompt(session, ws, prompt_id, timeout):
+    """
+    Wait on the ComfyUI websocket until the given prompt has finished executing
+
+    Whenever the websocket stays silent for the current poll interval, the queue
+    of ComfyUI is checked as a fallback. The interval starts at COMFY_POLLING_INITIAL_INTERVAL_MS
+    and grows by 1.5x up to COMFY_POLLING_INTERVAL_MS.
+
+    Args:
+        session (aiohttp.ClientSession): The session of the job
+        ws (aiohttp.ClientWebSocketResponse): A websocket connected to the /ws endpoint of ComfyUI
+        prompt_id (str): The ID of the prompt to wait for
+        timeout (float): The maximum time in seconds to wait
+
+    Returns:
+        bool: True if the prompt finished within the timeout, otherwise False
+    """
+    deadline = time.monotonic() + timeout
+    poll_interval = COMFY_POLLING_INITIAL_INTERVAL_MS / 1000
+
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+
+        try:
+            message = await ws.receive(timeout=min(poll_interval, remaining))
+        except asyncio.TimeoutError:
+            # The queue only lists the IDs, unlike the history it doesn't grow with
+            # the outputs of the prompt
+            if not await queue_contains(session, prompt_id):
+                return True
+            poll_interval = min(poll_interval * 1.5, COMFY_POLLING_INTERVAL_MS / 1000)
+            continue
+
+        if message.type in (
+            aiohttp.WSMsgType.CLOSE,
+            aiohttp.WSMsgType.CLOSED,
+            aiohttp.WSMsgType.ERROR,
+        ):
+            raise ConnectionError("The ComfyUI websocket was closed")
+
+        # Binary frames contain previews, only text frames carry status events
+        if message.type != aiohttp.WSMsgType.TEXT:
+            continue
+
+        message = orjson.loads(message.data)
+        if message["type"] == "executing":
+            data = message["data"]
+            # ComfyUI reports "node": None once the whole prompt is done
+            if data["node"] is None and data["prompt_id"] == prompt_id:
+                return True
 
 
 def base64_encode(img_path):
@@ -195,9 +533,82 @@ def base64_encode(img_path):
     Returns:
         str: The base64 encoded image
     """
+    encoded = bytearray()
     with open(img_path, "rb") as image_file:
-        encoded_string = base64.b64encode(image_file.read()).decode("utf-8")
-        return f"{encoded_string}"
+        # Read in blocks that are a multiple of 3 bytes, so no padding ends up in between
+        while chunk := image_file.read(BASE64_ENCODE_CHUNK_SIZE):
+            encoded += base64.b64encode(chunk)
+    return encoded.decode("ascii")
+
+
+def upload_output_file(job_id, local_file_path):
+    """
+    Upload an output file to the S3 bucket, big files use a multipart upload.
+
+    The object is stored like rp_upload does it, in a bucket named after the
+    current month and under a key prefixed with the job ID. When no bucket is
+    configured, this falls back to rp_upload, which keeps the file on disk.
+
+    Args:
+        job_id (str): The unique identifier for the job.
+        local_file_path (str): The path to the file that should be uploaded.
+
+    Returns:
+        str: The presigned URL of the uploaded file (or its simulated location)
+    """
+    if S3_CLIENT is None:
+        return rp_upload.upload_image(job_id, local_file_path)
+
+    bucket = time.strftime("%m-%y")
+    file_extension = os.path.splitext(local_file_path)[1]
+    key = f"{job_id}/{str(uuid.uuid4())[:8]}{file_extension}"
+    content_type = mimetypes.guess_type(local_file_path)[0] or "application/octet-stream"
+
+    # The body is read straight from the file handle, without a copy in memory
+    with open(local_file_path, "rb") as output_file:
+        if os.fstat(output_file.fileno()).st_size < S3_TRANSFER_CONFIG.multipart_threshold:
+            # Small files go out in a single request, without the transfer manager
+            S3_CLIENT.put_object(
+                Bucket=bucket, Key=key, Body=output_file, ContentType=content_type
+            )
+        else:
+            S3_CLIENT.upload_fileobj(
+                output_file,
+                bucket,
+                key,
+                ExtraArgs={"ContentType": content_type},
+                Config=S3_TRANSFER_CONFIG,
+            )
+
+    return S3_CLIENT.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": bucket, "Key": key},
+        ExpiresIn=S3_PRESIGNED_URL_EXPIRES_IN,
+    )
+
+
+def _find_output(outputs):
+    """
+    Find the first generated file (image or video) in the outputs of a workflow.
+
+    Args:
+        outputs (dict): The outputs from generation, keyed by node ID.
+
+    Returns:
+        tuple: The path of the file relative to the output folder and the full path
+               provided by ComfyUI (if any), or (None, None) if there is no file.
+    """
+    for node_id, node_output in outputs.items():
+        # Videos are reported by VideoHelperSuite as "gifs"
+        for key in ("images", "gifs"):
+            for item in node_output.get(key, ()):
+                log.debug("Found %s in node %s: %s", key, node_id, item)
+                return (
+                    os.path.join(item["subfolder"], item["filename"]),
+                    item.get("fullpath"),
+                )
+
+    return None, None
 
 
 def process_output_files(outputs, job_id):
@@ -213,33 +624,13 @@ def process_output_files(outputs, job_id):
         dict: A dictionary with the status ('success' or 'error') and the message,
               which is the URL to the file in AWS S3.
     """
-    COMFY_OUTPUT_PATH = os.environ.get("COMFY_OUTPUT_PATH", "/comfyui/output")
-    print(f"runpod-worker-comfy - Using output path: {COMFY_OUTPUT_PATH}")
-    print(f"runpod-worker-comfy - Processing outputs for job_id: {job_id}")
-    print(f"runpod-worker-comfy - Raw outputs received: {outputs}")
+    log.debug("Using output path: %s", COMFY_OUTPUT_PATH)
+    log.debug("Processing outputs for job_id: %s", job_id)
+    log.debug("Raw outputs received: %s", outputs)
 
-    output_file = None
-    full_path = None
+    output_file, full_path = _find_output(outputs)
 
-    print(f"runpod-worker-comfy - Processing node outputs...")
-    for node_id, node_output in outputs.items():
-        print(f"runpod-worker-comfy - Processing node {node_id}: {node_output}")
-        # Handle images
-        if "images" in node_output:
-            print(f"runpod-worker-comfy - Found images in node {node_id}")
-            for image in node_output["images"]:
-                print(f"runpod-worker-comfy - Image details: {image}")
-                output_file = os.path.join(image["subfolder"], image["filename"])
-                full_path = image.get("fullpath")
-        # Handle videos/gifs
-        if "gifs" in node_output:
-            print(f"runpod-worker-comfy - Found video in node {node_id}")
-            for video in node_output["gifs"]:
-                print(f"runpod-worker-comfy - Video details: {video}")
-                output_file = os.path.join(video["subfolder"], video["filename"])
-                full_path = video.get("fullpath")
-
-    print(f"runpod-worker-comfy - File generation is done")
+    log.info("File generation is done")
 
     if output_file is None:
         return {
@@ -247,54 +638,87 @@ def process_output_files(outputs, job_id):
             "message": "No output file found in the generation results"
         }
 
-    # Construct our path and compare with provided full path
-    local_file_path = f"{COMFY_OUTPUT_PATH}/{output_file}"
-    print(f"runpod-worker-comfy - Constructed local path: {local_file_path}")
-    print(f"runpod-worker-comfy - ComfyUI provided path: {full_path}")
-
     if full_path and os.path.exists(full_path):
-        print(f"runpod-worker-comfy - Using ComfyUI provided path")
+        # ComfyUI told us where the file is, so there is nothing to look for
+        log.debug("Using ComfyUI provided path: %s", full_path)
         local_file_path = full_path
-    elif not os.path.exists(local_file_path):
-        print(f"runpod-worker-comfy - Constructed path does not exist, trying ComfyUI path")
-        local_file_path = full_path
-
-    # Check if directory exists
-    dir_path = os.path.dirname(local_file_path)
-    print(f"runpod-worker-comfy - Directory path: {dir_path}")
-    if os.path.exists(dir_path):
-        print(f"runpod-worker-comfy - Directory exists")
-        print(f"runpod-worker-comfy - Directory contents: {os.listdir(dir_path)}")
     else:
-        print(f"runpod-worker-comfy - Directory does not exist!")
-
-    if os.path.exists(local_file_path):
-        print(f"runpod-worker-comfy - File exists at: {local_file_path}")
-        print(f"runpod-worker-comfy - File size: {os.path.getsize(local_file_path)} bytes")
-        print(f"runpod-worker-comfy - Attempting to upload to S3...")
-        
-        file_url = rp_upload.upload_image(job_id, local_file_path)
-        print(f"runpod-worker-comfy - File successfully uploaded to S3")
-        print(f"runpod-worker-comfy - S3 URL: {file_url}")
-        
-        return {
-            "status": "success",
-            "message": file_url,
-        }
-    else:
-        print(f"runpod-worker-comfy - File does not exist at: {local_file_path}")
-        return {
-            "status": "error",
-            "message": f"the file does not exist in the specified output folder: {local_file_path}",
-        }
+        # Construct our path and compare with provided full path
+        local_file_path = f"{COMFY_OUTPUT_PATH}/{output_file}"
+        log.debug("Constructed local path: %s", local_file_path)
+        log.debug("ComfyUI provided path: %s", full_path)
+
+        if full_path and not os.path.exists(local_file_path):
+            log.debug("Constructed path does not exist, trying ComfyUI path")
+            local_file_path = full_path
+
+        # Check if directory exists
+        dir_path = os.path.dirname(local_file_path)
+        log.debug("Directory path: %s", dir_path)
+        if os.path.exists(dir_path):
+            log.debug("Directory exists")
+        else:
+            log.warning("Directory does not exist!")
 
+        if not os.path.exists(local_file_path):
+            log.error("File does not exist at: %s", local_file_path)
+            return {
+                "status": "error",
+                "message": f"the file does not exist in the specified output folder: {local_file_path}",
+            }
 
-def handler(job):
+    log.debug("File exists at: %s", local_file_path)
+    log.info("Attempting to upload to S3...")
+
+    file_url = upload_output_file(job_id, local_file_path)
+    log.info("File successfully uploaded to S3")
+    log.info("S3 URL: %s", file_url)
+
+    return {
+        "status": "success",
+        "message": file_url,
+    }
+
+
+def should_refresh_worker(refresh_worker=None):
+    """
+    Decide if the worker should be stopped after the current job
+
+    Args:
+        refresh_worker (bool, optional): The choice of the job, falls back to REFRESH_WORKER if not given
+
+    Returns:
+        bool: True if the worker should be refreshed, otherwise False
+    """
+    if refresh_worker is None:
+        refresh_worker = REFRESH_WORKER
+    if refresh_worker:
+        return True
+
+    # A fresh worker has to load all models again, so only do this when the
+    # memory is running low
+    if REFRESH_WORKER_MEMORY_THRESHOLD > 0:
+        memory_percent = psutil.virtual_memory().percent
+        if memory_percent > REFRESH_WORKER_MEMORY_THRESHOLD:
+            log.info("system memory usage at %s%%, refreshing the worker", memory_percent)
+            return True
+
+    return False
+
+
+async def handler(job):
     """
     The main function that handles a job of generating an image.
 
     This function validates the input, sends a prompt to ComfyUI for processing,
-    polls ComfyUI for result, and retrieves generated images.
+    waits for ComfyUI to report that the prompt is done, and retrieves generated images.
+    All requests to ComfyUI of a job share one keep-alive aiohttp session.
+
+    The job input consists of the "workflow" (the ComfyUI workflow in API format) and
+    optional "images". Every image needs a "name" and either an "image" with the
+    base64 encoded data or a "url" the image is streamed from, e.g.:
+
+        {"workflow": {...}, "images": [{"name": "a.png", "url": "https://..."}]}
 
     Args:
         job (dict): A dictionary containing job details and input parameters.
@@ -313,54 +737,76 @@ def handler(job):
     workflow = validated_data["workflow"]
     images = validated_data.get("images")
 
-    # Make sure that the ComfyUI API is available
-    check_server(
-        f"http://{COMFY_HOST}",
-        COMFY_API_AVAILABLE_MAX_RETRIES,
-        COMFY_API_AVAILABLE_INTERVAL_MS,
-    )
-
-    # Upload images if they exist
-    upload_result = upload_images(images)
-
-    if upload_result["status"] == "error":
-        return upload_result
+    # The ComfyUI API is checked once when the worker starts, only check
+    # again if it wasn't available back then
+    if not _server_ready and not await asyncio.to_thread(wait_for_server):
+        return {"error": "ComfyUI API is not available"}
+
+    async with aiohttp.ClientSession(timeout=COMFY_CONNECT_TIMEOUT) as session:
+        # Subscribe to the execution events before queueing, so that we can't miss
+        # the message that tells us that our prompt is done. Both are independent of
+        # the images, so the connection is set up while the images are uploaded
+        client_id = str(uuid.uuid4())
+        ws, upload_result = await asyncio.gather(
+            connect_websocket(session, client_id),
+            # Upload images if they exist
+            upload_images(session, images),
+            return_exceptions=True,
+        )
+
+        if isinstance(ws, Exception):
+            return {"error": f"Error connecting to ComfyUI websocket: {str(ws)}"}
 
-    # Queue the workflow
-    try:
-        queued_workflow = queue_workflow(workflow)
-        prompt_id = queued_workflow["prompt_id"]
-        print(f"runpod-worker-comfy - queued workflow with ID {prompt_id}")
-    except Exception as e:
-        return {"error": f"Error queuing workflow: {str(e)}"}
-
-    # Poll for completion
-    print(f"runpod-worker-comfy - wait until image generation is complete")
-    retries = 0
-    try:
-        while retries < COMFY_POLLING_MAX_RETRIES:
-            history = get_history(prompt_id)
-
-            # Exit the loop if we have found the history
-            if prompt_id in history and history[prompt_id].get("outputs"):
-                break
-            else:
-                # Wait before trying again
-                time.sleep(COMFY_POLLING_INTERVAL_MS / 1000)
-                retries += 1
-        else:
-            return {"error": "Max retries reached while waiting for image generation"}
-    except Exception as e:
-        return {"error": f"Error waiting for image generation: {str(e)}"}
-
-    # Get the generated image and return it as URL in an AWS bucket or as base64
-    images_result = process_output_files(history[prompt_id].get("outputs"), job["id"])
+        try:
+            if isinstance(upload_result, Exception):
+                return {"error": f"Error uploading images: {str(upload_result)}"}
+            if upload_result["status"] == "error":
+                return upload_result
+
+            # Queue the workflow
+            try:
+                queued_workflow = await queue_workflow(session, workflow, client_id)
+                prompt_id = queued_workflow["prompt_id"]
+                log.info("queued workflow with ID %s", prompt_id)
+            except Exception as e:
+                return {"error": f"Error queuing workflow: {str(e)}"}
+
+            # Wait for completion
+            log.info("wait until image generation is complete")
+            try:
+                if not await wait_for_prompt(
+                    session,
+                    ws,
+                    prompt_id,
+                    COMFY_POLLING_MAX_RETRIES * COMFY_POLLING_INTERVAL_MS / 1000,
+                ):
+                    return {"error": "Timeout reached while waiting for image generation"}
+
+                history = await get_history(session, prompt_id)
+            except Exception as e:
+                return {"error": f"Error waiting for image generation: {str(e)}"}
+        finally:
+            await ws.close()
+
+    if prompt_id not in history or not history[prompt_id].get("outputs"):
+        return {"error": "No outputs found in the history of the workflow"}
+
+    # Get the generated image and return it as URL in an AWS bucket or as base64,
+    # the upload to S3 is blocking, so it runs in a thread
+    images_result = await asyncio.to_thread(
+        process_output_files, history[prompt_id].get("outputs"), job["id"]
+    )
 
-    result = {**images_result, "refresh_worker": REFRESH_WORKER}
+    result = {
+        **images_result,
+        "refresh_worker": should_refresh_worker(validated_data["refresh_worker"]),
+    }
 
     return result
 
 
 # Start the handler only if this script is run directly
 if __name__ == "__main__":
+    # Wait for ComfyUI once per container instead of in every job
+    wait_for_server()
     runpod.serverless.start({"handler": handler})
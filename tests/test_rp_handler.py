@@ -1,9 +1,13 @@
 import unittest
-from unittest.mock import patch, MagicMock, mock_open, Mock
+from unittest.mock import patch, MagicMock, mock_open, Mock, AsyncMock
 import sys
 import os
 import json
 import base64
+import binascii
+import asyncio
+from aiohttp import WSMessage, WSMsgType, web
+from aiohttp.test_utils import TestServer
 
 # Make sure that "src" is known and can be used to import rp_handler.py
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
@@ -13,12 +17,30 @@ from src import rp_handler
 RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES = "./test_resources/images"
 
 
+def mock_response(status=200, body=b"", text=""):
+    """Create a mocked aiohttp response that can be used with "async with" """
+    response = MagicMock()
+    response.status = status
+    response.read = AsyncMock(return_value=body)
+    response.text = AsyncMock(return_value=text)
+    response.__aenter__.return_value = response
+    return response
+
+
+def ws_text(data):
+    """Create a text message as it is received from the ComfyUI websocket"""
+    return WSMessage(WSMsgType.TEXT, json.dumps(data), None)
+
+
 class TestRunpodWorkerComfy(unittest.TestCase):
     def test_valid_input_with_workflow_only(self):
         input_data = {"workflow": {"key": "value"}}
         validated_data, error = rp_handler.validate_input(input_data)
         self.assertIsNone(error)
-        self.assertEqual(validated_data, {"workflow": {"key": "value"}, "images": None})
+        self.assertEqual(
+            validated_data,
+            {"workflow": {"key": "value"}, "images": None, "refresh_worker": None},
+        )
 
     def test_valid_input_with_workflow_and_images(self):
         input_data = {
@@ -27,7 +49,7 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         }
         validated_data, error = rp_handler.validate_input(input_data)
         self.assertIsNone(error)
-        self.assertEqual(validated_data, input_data)
+        self.assertEqual(validated_data, {**input_data, "refresh_worker": None})
 
     def test_input_missing_workflow(self):
         input_data = {"images": [{"name": "image1.png", "image": "base64string"}]}
@@ -43,9 +65,124 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         validated_data, error = rp_handler.validate_input(input_data)
         self.assertIsNotNone(error)
         self.assertEqual(
-            error, "'images' must be a list of objects with 'name' and 'image' keys"
+            error,
+            "'images' must be a list of objects with 'name' and 'image' or 'url' keys",
+        )
+
+    def test_input_with_images_not_objects(self):
+        input_data = {"workflow": {"key": "value"}, "images": ["image1.png"]}
+        validated_data, error = rp_handler.validate_input(input_data)
+        self.assertIsNotNone(error)
+        self.assertEqual(
+            error,
+            "'images' must be a list of objects with 'name' and 'image' or 'url' keys",
+        )
+
+    def test_input_with_invalid_base64_length(self):
+        input_data = {
+            "workflow": {"key": "value"},
+            "images": [{"name": "image1.png", "image": "base64strin"}],
+        }
+        validated_data, error = rp_handler.validate_input(input_data)
+        self.assertIsNotNone(error)
+        self.assertEqual(error, "'image' of 'image1.png' is not a valid base64 string")
+
+    def test_valid_input_with_line_wrapped_base64(self):
+        input_data = {
+            "workflow": {"key": "value"},
+            "images": [
+                {"name": "image1.png", "image": base64.encodebytes(b"x" * 100).decode("utf-8")}
+            ],
+        }
+        validated_data, error = rp_handler.validate_input(input_data)
+        self.assertIsNone(error)
+
+    def test_input_with_invalid_image_name(self):
+        input_data = {
+            "workflow": {"key": "value"},
+            "images": [{"name": 5, "image": "QUJD"}],
+        }
+        validated_data, error = rp_handler.validate_input(input_data)
+        self.assertIsNotNone(error)
+        self.assertEqual(error, "'name' of every image must be a non-empty string")
+
+    def test_input_with_null_image_url(self):
+        input_data = {
+            "workflow": {"key": "value"},
+            "images": [{"name": "image1.png", "url": None}],
+        }
+        validated_data, error = rp_handler.validate_input(input_data)
+        self.assertIsNotNone(error)
+        self.assertEqual(error, "'url' of 'image1.png' must be a non-empty string")
+
+    def test_input_with_non_string_image_url(self):
+        input_data = {
+            "workflow": {"key": "value"},
+            "images": [{"name": "image1.png", "url": 12}],
+        }
+        validated_data, error = rp_handler.validate_input(input_data)
+        self.assertIsNotNone(error)
+        self.assertEqual(error, "'url' of 'image1.png' must be a non-empty string")
+
+    @patch("src.rp_handler.MAX_IMAGE_B64", 8)
+    def test_input_with_oversized_image(self):
+        input_data = {
+            "workflow": {"key": "value"},
+            "images": [{"name": "image1.png", "image": "base64string"}],
+        }
+        validated_data, error = rp_handler.validate_input(input_data)
+        self.assertIsNotNone(error)
+        self.assertEqual(
+            error, "'image' of 'image1.png' exceeds the maximum size of 8 characters"
         )
 
+    @patch("src.rp_handler.MAX_IMAGE_B64", 8)
+    def test_input_with_oversized_image_invalid_length(self):
+        input_data = {
+            "workflow": {"key": "value"},
+            "images": [{"name": "image1.png", "image": "base64strin"}],
+        }
+        validated_data, error = rp_handler.validate_input(input_data)
+        self.assertIsNotNone(error)
+        self.assertEqual(
+            error, "'image' of 'image1.png' exceeds the maximum size of 8 characters"
+        )
+
+    def test_valid_input_with_image_url(self):
+        input_data = {
+            "workflow": {"key": "value"},
+            "images": [{"name": "image1.png", "url": "https://example.com/image1.png"}],
+        }
+        validated_data, error = rp_handler.validate_input(input_data)
+        self.assertIsNone(error)
+        self.assertEqual(validated_data, {**input_data, "refresh_worker": None})
+
+    def test_valid_input_with_refresh_worker(self):
+        input_data = {"workflow": {"key": "value"}, "refresh_worker": True}
+        validated_data, error = rp_handler.validate_input(input_data)
+        self.assertIsNone(error)
+        self.assertTrue(validated_data["refresh_worker"])
+
+    def test_input_with_invalid_refresh_worker(self):
+        input_data = {"workflow": {"key": "value"}, "refresh_worker": "yes"}
+        validated_data, error = rp_handler.validate_input(input_data)
+        self.assertIsNotNone(error)
+        self.assertEqual(error, "'refresh_worker' must be a boolean")
+
+    @patch("src.rp_handler.REFRESH_WORKER", True)
+    def test_should_refresh_worker_job_overrides_env(self):
+        self.assertTrue(rp_handler.should_refresh_worker())
+        self.assertFalse(rp_handler.should_refresh_worker(False))
+
+    @patch("src.rp_handler.psutil.virtual_memory")
+    @patch("src.rp_handler.REFRESH_WORKER_MEMORY_THRESHOLD", 90)
+    def test_should_refresh_worker_memory_threshold(self, mock_virtual_memory):
+        mock_virtual_memory.return_value = MagicMock(percent=95.0)
+        self.assertTrue(rp_handler.should_refresh_worker())
+
+        mock_virtual_memory.return_value = MagicMock(percent=50.0)
+        self.assertFalse(rp_handler.should_refresh_worker())
+
     def test_invalid_json_string_input(self):
         input_data = "invalid json"
         validated_data, error = rp_handler.validate_input(input_data)
@@ -56,7 +193,10 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         input_data = '{"workflow": {"key": "value"}}'
         validated_data, error = rp_handler.validate_input(input_data)
         self.assertIsNone(error)
-        self.assertEqual(validated_data, {"workflow": {"key": "value"}, "images": None})
+        self.assertEqual(
+            validated_data,
+            {"workflow": {"key": "value"}, "images": None, "refresh_worker": None},
+        )
 
     def test_empty_input(self):
         input_data = None
@@ -64,55 +204,42 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         self.assertIsNotNone(error)
         self.assertEqual(error, "Please provide input")
 
-    @patch("rp_handler.requests.get")
-    def test_check_server_server_up(self, mock_requests):
+    @patch("src.rp_handler.requests.get")
+    def test_check_server_server_up(self, mock_get):
         mock_response = MagicMock()
         mock_response.status_code = 200
-        mock_requests.return_value = mock_response
+        mock_get.return_value = mock_response
 
         result = rp_handler.check_server("http://127.0.0.1:8188", 1, 50)
         self.assertTrue(result)
+        mock_get.assert_called_with("http://127.0.0.1:8188", timeout=2)
 
-    @patch("rp_handler.requests.get")
-    def test_check_server_server_down(self, mock_requests):
-        mock_requests.get.side_effect = rp_handler.requests.RequestException()
+    @patch("src.rp_handler.requests.get")
+    def test_check_server_server_down(self, mock_get):
+        mock_get.side_effect = rp_handler.requests.RequestException()
         result = rp_handler.check_server("http://127.0.0.1:8188", 1, 50)
         self.assertFalse(result)
 
-    @patch("rp_handler.urllib.request.urlopen")
-    def test_queue_prompt(self, mock_urlopen):
-        mock_response = MagicMock()
-        mock_response.read.return_value = json.dumps({"prompt_id": "123"}).encode()
-        mock_urlopen.return_value = mock_response
-        result = rp_handler.queue_workflow({"prompt": "test"})
-        self.assertEqual(result, {"prompt_id": "123"})
-
-    @patch("rp_handler.urllib.request.urlopen")
-    def test_get_history(self, mock_urlopen):
-        # Mock response data as a JSON string
-        mock_response_data = json.dumps({"key": "value"}).encode("utf-8")
-
-        # Define a mock response function for `read`
-        def mock_read():
-            return mock_response_data
+    @patch("src.rp_handler.time.sleep")
+    @patch("src.rp_handler.time.monotonic")
+    @patch("src.rp_handler.requests.get")
+    def test_check_server_gives_up_after_timeout(self, mock_get, mock_monotonic, mock_sleep):
+        mock_get.side_effect = rp_handler.requests.RequestException()
+        # Every attempt takes a second
+        mock_monotonic.side_effect = [float(i) for i in range(100)]
 
-        # Create a mock response object
-        mock_response = Mock()
-        mock_response.read = mock_read
+        result = rp_handler.check_server("http://127.0.0.1:8188", 500, 10, 500, 5000)
 
-        # Mock the __enter__ and __exit__ methods to support the context manager
-        mock_response.__enter__ = lambda s: s
-        mock_response.__exit__ = Mock()
+        self.assertFalse(result)
+        self.assertEqual(mock_get.call_count, 5)
 
-        # Set the return value of the urlopen mock
-        mock_urlopen.return_value = mock_response
+    @patch("src.rp_handler.check_server")
+    def test_wait_for_server_remembers_result(self, mock_check_server):
+        mock_check_server.return_value = True
 
-        # Call the function under test
-        result = rp_handler.get_history("123")
-
-        # Assertions
-        self.assertEqual(result, {"key": "value"})
-        mock_urlopen.assert_called_with("http://127.0.0.1:8188/history/123")
+        with patch("src.rp_handler._server_ready", False):
+            self.assertTrue(rp_handler.wait_for_server())
+            self.assertTrue(rp_handler._server_ready)
 
     @patch("builtins.open", new_callable=mock_open, read_data=b"test")
     def test_base64_encode(self, mock_file):
@@ -122,11 +249,21 @@ class TestRunpodWorkerComfy(unittest.TestCase):
 
         self.assertEqual(result, test_data)
 
+    def test_base64_encode_multiple_chunks(self):
+        img_path = os.path.join(
+            RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES, "ComfyUI_00001_.png"
+        )
+        with open(img_path, "rb") as image_file:
+            test_data = base64.b64encode(image_file.read()).decode("utf-8")
+
+        with patch("src.rp_handler.BASE64_ENCODE_CHUNK_SIZE", 3 * 1024):
+            result = rp_handler.base64_encode(img_path)
+
+        self.assertEqual(result, test_data)
+
     @patch("rp_handler.os.path.exists")
     @patch("rp_handler.rp_upload.upload_image")
-    @patch.dict(
-        os.environ, {"COMFY_OUTPUT_PATH": RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES}
-    )
+    @patch("src.rp_handler.COMFY_OUTPUT_PATH", RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES)
     def test_bucket_endpoint_not_configured(self, mock_upload_image, mock_exists):
         mock_exists.return_value = True
         mock_upload_image.return_value = "simulated_uploaded/image.png"
@@ -136,20 +273,16 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         }
         job_id = "123"
 
-        result = rp_handler.process_output_images(outputs, job_id)
+        result = rp_handler.process_output_files(outputs, job_id)
 
         self.assertEqual(result["status"], "success")
 
     @patch("rp_handler.os.path.exists")
     @patch("rp_handler.rp_upload.upload_image")
-    @patch.dict(
-        os.environ,
-        {
-            "COMFY_OUTPUT_PATH": RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES,
-            "BUCKET_ENDPOINT_URL": "http://example.com",
-        },
-    )
-    def test_bucket_endpoint_configured(self, mock_upload_image, mock_exists):
+    @patch("src.rp_handler.COMFY_OUTPUT_PATH", RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES)
+    # The S3 client is created at import, without a bucket it falls back to rp_upload
+    @patch("src.rp_handler.S3_CLIENT", None)
+    def test_bucket_not_configured_uses_rp_upload(self, mock_upload_image, mock_exists):
         # Mock the os.path.exists to return True, simulating that the image exists
         mock_exists.return_value = True
 
@@ -161,7 +294,7 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         job_id = "123"
 
         # Call the function under test
-        result = rp_handler.process_output_images(outputs, job_id)
+        result = rp_handler.process_output_files(outputs, job_id)
 
         # Assertions
         self.assertEqual(result["status"], "success")
@@ -172,15 +305,8 @@ class TestRunpodWorkerComfy(unittest.TestCase):
 
     @patch("rp_handler.os.path.exists")
     @patch("rp_handler.rp_upload.upload_image")
-    @patch.dict(
-        os.environ,
-        {
-            "COMFY_OUTPUT_PATH": RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES,
-            "BUCKET_ENDPOINT_URL": "http://example.com",
-            "BUCKET_ACCESS_KEY_ID": "",
-            "BUCKET_SECRET_ACCESS_KEY": "",
-        },
-    )
+    @patch("src.rp_handler.COMFY_OUTPUT_PATH", RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES)
+    @patch("src.rp_handler.S3_CLIENT", None)
     def test_bucket_image_upload_fails_env_vars_wrong_or_missing(
         self, mock_upload_image, mock_exists
     ):
@@ -195,40 +321,500 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         }
         job_id = "123"
 
-        result = rp_handler.process_output_images(outputs, job_id)
+        result = rp_handler.process_output_files(outputs, job_id)
 
         # Check if the image was saved to the 'simulated_uploaded' directory
         self.assertIn("simulated_uploaded", result["message"])
         self.assertEqual(result["status"], "success")
 
-    @patch("rp_handler.requests.post")
-    def test_upload_images_successful(self, mock_post):
-        mock_response = unittest.mock.Mock()
-        mock_response.status_code = 200
-        mock_response.text = "Successfully uploaded"
-        mock_post.return_value = mock_response
+    @patch("src.rp_handler.S3_CLIENT")
+    @patch("src.rp_handler.COMFY_OUTPUT_PATH", RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES)
+    def test_bucket_single_request_upload(self, mock_s3_client):
+        mock_s3_client.generate_presigned_url.return_value = (
+            "https://bucket.s3.region.amazonaws.com/123/image.png"
+        )
+
+        outputs = {
+            "node_id": {"images": [{"filename": "ComfyUI_00001_.png", "subfolder": ""}]}
+        }
+
+        result = rp_handler.process_output_files(outputs, "123")
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(
+            result["message"], "https://bucket.s3.region.amazonaws.com/123/image.png"
+        )
+        mock_s3_client.upload_fileobj.assert_not_called()
+        kwargs = mock_s3_client.put_object.call_args.kwargs
+        self.assertTrue(kwargs["Key"].startswith("123/"))
+        self.assertEqual(kwargs["ContentType"], "image/png")
+        self.assertEqual(
+            kwargs["Body"].name, "./test_resources/images/ComfyUI_00001_.png"
+        )
+
+    @patch("src.rp_handler.S3_CLIENT")
+    @patch("src.rp_handler.COMFY_OUTPUT_PATH", RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES)
+    def test_bucket_multipart_upload(self, mock_s3_client):
+        outputs = {
+            "node_id": {"images": [{"filename": "ComfyUI_00001_.png", "subfolder": ""}]}
+        }
+
+        with patch.object(rp_handler.S3_TRANSFER_CONFIG, "multipart_threshold", 1024):
+            result = rp_handler.process_output_files(outputs, "123")
+
+        self.assertEqual(result["status"], "success")
+        mock_s3_client.put_object.assert_not_called()
+        args, kwargs = mock_s3_client.upload_fileobj.call_args
+        self.assertEqual(args[0].name, "./test_resources/images/ComfyUI_00001_.png")
+        self.assertTrue(args[2].startswith("123/"))
+        self.assertEqual(kwargs["ExtraArgs"], {"ContentType": "image/png"})
+        self.assertIs(kwargs["Config"], rp_handler.S3_TRANSFER_CONFIG)
+
+    def test_find_output_returns_first_file(self):
+        outputs = {
+            "1": {"text": ["no files here"]},
+            "2": {
+                "gifs": [
+                    {
+                        "filename": "video.mp4",
+                        "subfolder": "lipsync",
+                        "fullpath": "/out/lipsync/video.mp4",
+                    }
+                ]
+            },
+            "3": {"images": [{"filename": "ComfyUI_00001_.png", "subfolder": ""}]},
+        }
+
+        result = rp_handler._find_output(outputs)
+
+        self.assertEqual(
+            result, (os.path.join("lipsync", "video.mp4"), "/out/lipsync/video.mp4")
+        )
+
+    def test_find_output_without_files(self):
+        result = rp_handler._find_output({"1": {"text": ["no files here"]}})
+
+        self.assertEqual(result, (None, None))
+
+    @patch("src.rp_handler.upload_output_file")
+    def test_output_uses_comfyui_provided_path(self, mock_upload_file):
+        full_path = os.path.abspath(
+            os.path.join(RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES, "ComfyUI_00001_.png")
+        )
+        mock_upload_file.return_value = "http://example.com/uploaded/image.png"
+
+        outputs = {
+            "node_id": {
+                "images": [
+                    {
+                        "filename": "ComfyUI_00001_.png",
+                        "subfolder": "",
+                        "fullpath": full_path,
+                    }
+                ]
+            }
+        }
+
+        result = rp_handler.process_output_files(outputs, "123")
+
+        self.assertEqual(result["status"], "success")
+        mock_upload_file.assert_called_once_with("123", full_path)
+
+    @patch("src.rp_handler.os.listdir")
+    @patch("src.rp_handler.COMFY_OUTPUT_PATH", RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES)
+    def test_output_file_missing(self, mock_listdir):
+        outputs = {"node_id": {"images": [{"filename": "missing.png", "subfolder": ""}]}}
+
+        result = rp_handler.process_output_files(outputs, "123")
+
+        self.assertEqual(result["status"], "error")
+        self.assertIn("./test_resources/images/missing.png", result["message"])
+        # The output folder keeps the files of all jobs, so it's never listed
+        mock_listdir.assert_not_called()
+
+
+class TestRunpodWorkerComfyAsync(unittest.IsolatedAsyncioTestCase):
+    @patch("src.rp_handler.check_server")
+    async def test_handler_server_not_available(self, mock_check_server):
+        mock_check_server.return_value = False
+
+        with patch("src.rp_handler._server_ready", False), patch(
+            "src.rp_handler.connect_websocket", new_callable=AsyncMock
+        ) as mock_connect_websocket:
+            result = await rp_handler.handler({"id": "123", "input": {"workflow": {}}})
+
+        self.assertEqual(result, {"error": "ComfyUI API is not available"})
+        mock_connect_websocket.assert_not_awaited()
+
+    @patch("src.rp_handler.process_output_files")
+    @patch("src.rp_handler.get_history", new_callable=AsyncMock)
+    @patch("src.rp_handler.wait_for_prompt", new_callable=AsyncMock)
+    @patch("src.rp_handler.queue_workflow", new_callable=AsyncMock)
+    @patch("src.rp_handler.upload_images", new_callable=AsyncMock)
+    @patch("src.rp_handler.connect_websocket", new_callable=AsyncMock)
+    async def test_handler_successful(
+        self,
+        mock_connect_websocket,
+        mock_upload_images,
+        mock_queue_workflow,
+        mock_wait_for_prompt,
+        mock_get_history,
+        mock_process_output_files,
+    ):
+        mock_ws = AsyncMock()
+        mock_connect_websocket.return_value = mock_ws
+        mock_upload_images.return_value = {"status": "success"}
+        mock_queue_workflow.return_value = {"prompt_id": "456"}
+        mock_wait_for_prompt.return_value = True
+        mock_get_history.return_value = {"456": {"outputs": {"9": {}}}}
+        mock_process_output_files.return_value = {
+            "status": "success",
+            "message": "http://example.com/uploaded/image.png",
+        }
+
+        with patch("src.rp_handler._server_ready", True):
+            result = await rp_handler.handler({"id": "123", "input": {"workflow": {}}})
+
+        self.assertEqual(result["status"], "success")
+        self.assertFalse(result["refresh_worker"])
+        # The prompt is queued for the client that listens on the websocket
+        session, client_id = mock_connect_websocket.call_args.args
+        mock_queue_workflow.assert_awaited_once_with(session, {}, client_id)
+        mock_process_output_files.assert_called_once_with({"9": {}}, "123")
+        mock_ws.close.assert_awaited_once()
+
+    @patch("src.rp_handler.upload_images", new_callable=AsyncMock)
+    @patch("src.rp_handler.connect_websocket", new_callable=AsyncMock)
+    async def test_handler_upload_failed(
+        self, mock_connect_websocket, mock_upload_images
+    ):
+        mock_ws = AsyncMock()
+        mock_connect_websocket.return_value = mock_ws
+        upload_result = {"status": "error", "message": "Some images failed to upload"}
+        mock_upload_images.return_value = upload_result
+
+        with patch("src.rp_handler._server_ready", True):
+            result = await rp_handler.handler({"id": "123", "input": {"workflow": {}}})
+
+        self.assertEqual(result, upload_result)
+        mock_ws.close.assert_awaited_once()
+
+    @patch("src.rp_handler.upload_images", new_callable=AsyncMock)
+    @patch("src.rp_handler.connect_websocket", new_callable=AsyncMock)
+    async def test_handler_upload_raised(
+        self, mock_connect_websocket, mock_upload_images
+    ):
+        mock_ws = AsyncMock()
+        mock_connect_websocket.return_value = mock_ws
+        mock_upload_images.side_effect = ValueError("Unexpected error")
+
+        with patch("src.rp_handler._server_ready", True):
+            result = await rp_handler.handler({"id": "123", "input": {"workflow": {}}})
+
+        self.assertEqual(result, {"error": "Error uploading images: Unexpected error"})
+        mock_ws.close.assert_awaited_once()
+
+    async def test_queue_prompt(self):
+        session = MagicMock()
+        session.post.return_value = mock_response(
+            body=json.dumps({"prompt_id": "123"}).encode()
+        )
+
+        result = await rp_handler.queue_workflow(session, {"prompt": "test"})
+
+        self.assertEqual(result, {"prompt_id": "123"})
+        _, kwargs = session.post.call_args
+        self.assertEqual(kwargs["headers"], {"Content-Type": "application/json"})
+        self.assertEqual(json.loads(kwargs["data"]), {"prompt": {"prompt": "test"}})
+
+    async def test_get_history(self):
+        session = MagicMock()
+        session.get.return_value = mock_response(
+            body=json.dumps({"key": "value"}).encode("utf-8")
+        )
+
+        result = await rp_handler.get_history(session, "123")
+
+        self.assertEqual(result, {"key": "value"})
+        session.get.assert_called_with(
+            "http://127.0.0.1:8188/history/123", timeout=rp_handler.COMFY_REQUEST_TIMEOUT
+        )
+
+    async def test_queue_contains(self):
+        session = MagicMock()
+        session.get.return_value = mock_response(
+            body=json.dumps(
+                {
+                    "queue_running": [[1, "123", {}, {}, []]],
+                    "queue_pending": [[2, "456", {}, {}, []]],
+                }
+            ).encode("utf-8")
+        )
+
+        self.assertTrue(await rp_handler.queue_contains(session, "123"))
+        self.assertTrue(await rp_handler.queue_contains(session, "456"))
+        self.assertFalse(await rp_handler.queue_contains(session, "789"))
+        session.get.assert_called_with(
+            "http://127.0.0.1:8188/queue", timeout=rp_handler.COMFY_REQUEST_TIMEOUT
+        )
+
+    async def test_wait_for_prompt_done(self):
+        mock_ws = MagicMock()
+        mock_ws.receive = AsyncMock(
+            side_effect=[
+                ws_text({"type": "status", "data": {"status": {}}}),
+                WSMessage(WSMsgType.BINARY, b"binary preview", None),
+                ws_text({"type": "executing", "data": {"node": "3", "prompt_id": "123"}}),
+                ws_text({"type": "executing", "data": {"node": None, "prompt_id": "456"}}),
+                ws_text({"type": "executing", "data": {"node": None, "prompt_id": "123"}}),
+            ]
+        )
+
+        result = await rp_handler.wait_for_prompt(MagicMock(), mock_ws, "123", 10)
+
+        self.assertTrue(result)
+        self.assertEqual(mock_ws.receive.await_count, 5)
+
+    async def test_wait_for_prompt_websocket_closed(self):
+        mock_ws = MagicMock()
+        mock_ws.receive = AsyncMock(
+            return_value=WSMessage(WSMsgType.CLOSED, None, None)
+        )
+
+        with self.assertRaises(ConnectionError):
+            await rp_handler.wait_for_prompt(MagicMock(), mock_ws, "123", 10)
+
+    @patch("src.rp_handler.queue_contains", new_callable=AsyncMock)
+    async def test_wait_for_prompt_timeout(self, mock_queue_contains):
+        mock_queue_contains.return_value = True
+        mock_ws = MagicMock()
+        mock_ws.receive = AsyncMock(side_effect=asyncio.TimeoutError())
+
+        result = await rp_handler.wait_for_prompt(MagicMock(), mock_ws, "123", 0.01)
+
+        self.assertFalse(result)
+
+    @patch("src.rp_handler.queue_contains", new_callable=AsyncMock)
+    async def test_wait_for_prompt_queue_fallback(self, mock_queue_contains):
+        mock_queue_contains.side_effect = [True, False]
+        mock_ws = MagicMock()
+        mock_ws.receive = AsyncMock(side_effect=asyncio.TimeoutError())
+
+        result = await rp_handler.wait_for_prompt(MagicMock(), mock_ws, "123", 10)
+
+        self.assertTrue(result)
+        self.assertEqual(mock_queue_contains.await_count, 2)
+        # The poll interval grows with every miss
+        timeouts = [call.kwargs["timeout"] for call in mock_ws.receive.call_args_list]
+        self.assertAlmostEqual(timeouts[0], 0.5, places=2)
+        self.assertAlmostEqual(timeouts[1], 0.75, places=2)
+
+    async def test_decode_base64_chunks(self):
+        data = os.urandom(3 * rp_handler.BASE64_DECODE_CHUNK_SIZE + 5)
+        encoded = base64.b64encode(data).decode("utf-8")
+
+        chunks = [chunk async for chunk in rp_handler._decode_base64_chunks(encoded)]
+
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(b"".join(chunks), data)
+
+    async def test_decode_base64_chunks_line_wrapped(self):
+        data = os.urandom(3 * rp_handler.BASE64_DECODE_CHUNK_SIZE + 5)
+        # 76-character lines, as written by base64.encodebytes
+        encoded = base64.encodebytes(data).decode("utf-8")
+
+        chunks = [chunk async for chunk in rp_handler._decode_base64_chunks(encoded)]
+
+        self.assertEqual(b"".join(chunks), data)
+
+    async def test_decode_base64_chunks_incomplete(self):
+        with self.assertRaises(binascii.Error):
+            [chunk async for chunk in rp_handler._decode_base64_chunks("QUJDRA")]
+
+    async def test_post_image(self):
+        session = MagicMock()
+        session.post.return_value = mock_response(text='{"name": "test_image.png"}')
+
+        status, text = await rp_handler._post_image(session, "test_image.png", b"data")
+
+        self.assertEqual(status, 200)
+        self.assertEqual(text, '{"name": "test_image.png"}')
+        args, kwargs = session.post.call_args
+        self.assertEqual(args[0], "http://127.0.0.1:8188/upload/image")
+        self.assertIsInstance(kwargs["data"], rp_handler.aiohttp.FormData)
+
+    @patch(
+        "src.rp_handler.COMFY_REQUEST_TIMEOUT",
+        rp_handler.aiohttp.ClientTimeout(sock_connect=1, sock_read=0.2),
+    )
+    async def test_post_image_slow_body(self):
+        # Sending the body takes longer than the read timeout of a request
+        async def upload(request):
+            form = await request.post()
+            return web.Response(text=form["image"].file.read().decode())
+
+        async def slow_body():
+            for _ in range(4):
+                await asyncio.sleep(0.1)
+                yield b"data"
+
+        app = web.Application()
+        app.router.add_post("/upload/image", upload)
+        async with TestServer(app) as server:
+            with patch("src.rp_handler.COMFY_HOST", f"{server.host}:{server.port}"):
+                async with rp_handler.aiohttp.ClientSession() as session:
+                    status, text = await rp_handler._post_image(
+                        session, "test_image.png", slow_body()
+                    )
+
+        self.assertEqual(status, 200)
+        self.assertEqual(text, "datadatadatadata")
+
+    @patch("src.rp_handler._post_image", new_callable=AsyncMock)
+    async def test_upload_images_successful(self, mock_post_image):
+        mock_post_image.return_value = (200, "Successfully uploaded")
 
         test_image_data = base64.b64encode(b"Test Image Data").decode("utf-8")
 
         images = [{"name": "test_image.png", "image": test_image_data}]
 
-        responses = rp_handler.upload_images(images)
+        responses = await rp_handler.upload_images(MagicMock(), images)
 
         self.assertEqual(len(responses), 3)
         self.assertEqual(responses["status"], "success")
 
-    @patch("rp_handler.requests.post")
-    def test_upload_images_failed(self, mock_post):
-        mock_response = unittest.mock.Mock()
-        mock_response.status_code = 400
-        mock_response.text = "Error uploading"
-        mock_post.return_value = mock_response
+    @patch("src.rp_handler._post_image", new_callable=AsyncMock)
+    async def test_upload_images_failed(self, mock_post_image):
+        mock_post_image.return_value = (400, "Error uploading")
 
         test_image_data = base64.b64encode(b"Test Image Data").decode("utf-8")
 
         images = [{"name": "test_image.png", "image": test_image_data}]
 
-        responses = rp_handler.upload_images(images)
+        responses = await rp_handler.upload_images(MagicMock(), images)
 
         self.assertEqual(len(responses), 3)
         self.assertEqual(responses["status"], "error")
+
+    @patch("src.rp_handler._post_image", new_callable=AsyncMock)
+    async def test_upload_images_from_url(self, mock_post_image):
+        mock_post_image.return_value = (200, "ok")
+        source = mock_response()
+        session = MagicMock()
+        session.get.return_value = source
+
+        images = [{"name": "test_image.png", "url": "https://example.com/image.png"}]
+
+        responses = await rp_handler.upload_images(session, images)
+
+        self.assertEqual(responses["status"], "success")
+        session.get.assert_called_once_with(
+            "https://example.com/image.png", timeout=rp_handler.COMFY_REQUEST_TIMEOUT
+        )
+        # The download is streamed into the upload without decoding it
+        mock_post_image.assert_awaited_once_with(
+            session, "test_image.png", source.content
+        )
+
+    async def test_upload_images_from_url_download_failed(self):
+        session = MagicMock()
+        session.get.side_effect = rp_handler.aiohttp.ClientConnectionError(
+            "unreachable"
+        )
+
+        images = [{"name": "test_image.png", "url": "https://example.com/image.png"}]
+
+        responses = await rp_handler.upload_images(session, images)
+
+        self.assertEqual(responses["status"], "error")
+        self.assertEqual(
+            responses["details"], ["Error uploading test_image.png: unreachable"]
+        )
+
+    @patch("src.rp_handler.connect_websocket", new_callable=AsyncMock)
+    async def test_handler_websocket_failed(self, mock_connect_websocket):
+        mock_connect_websocket.side_effect = rp_handler.aiohttp.ClientConnectionError(
+            "refused"
+        )
+
+        with patch("src.rp_handler._server_ready", True):
+            result = await rp_handler.handler({"id": "123", "input": {"workflow": {}}})
+
+        self.assertEqual(
+            result, {"error": "Error connecting to ComfyUI websocket: refused"}
+        )
+
+    @patch("src.rp_handler.COMFY_REQUEST_TIMEOUT_S", 0.01)
+    async def test_connect_websocket_handshake_timeout(self):
+        async def hang(url, **kwargs):
+            await asyncio.sleep(1)
+
+        session = MagicMock()
+        session.ws_connect = AsyncMock(side_effect=hang)
+
+        with self.assertRaises(ConnectionError):
+            await rp_handler.connect_websocket(session, "client")
+
+    async def test_connect_websocket_large_message(self):
+        # Bigger than the default limit of aiohttp (4 MB)
+        preview = b"x" * (5 * 1024 * 1024)
+
+        async def websocket(request):
+            ws = web.WebSocketResponse()
+            await ws.prepare(request)
+            await ws.send_bytes(preview)
+            await ws.send_json(
+                {"type": "executing", "data": {"node": None, "prompt_id": "123"}}
+            )
+            await ws.close()
+            return ws
+
+        app = web.Application()
+        app.router.add_get("/ws", websocket)
+        async with TestServer(app) as server:
+            with patch("src.rp_handler.COMFY_HOST", f"{server.host}:{server.port}"):
+                async with rp_handler.aiohttp.ClientSession() as session:
+                    ws = await rp_handler.connect_websocket(session, "client")
+                    try:
+                        result = await rp_handler.wait_for_prompt(session, ws, "123", 10)
+                    finally:
+                        await ws.close()
+
+        self.assertTrue(result)
+
+    async def test_upload_images_invalid_base64(self):
+        session = MagicMock()
+        session.post.side_effect = rp_handler.binascii.Error("Incorrect padding")
+
+        images = [{"name": "test_image.png", "image": "QUJ\n"}]
+
+        responses = await rp_handler.upload_images(session, images)
+
+        self.assertEqual(responses["status"], "error")
+        self.assertEqual(
+            responses["details"], ["Error uploading test_image.png: Incorrect padding"]
+        )
+
+    @patch("src.rp_handler._post_image", new_callable=AsyncMock)
+    async def test_upload_images_multiple_partially_failed(self, mock_post_image):
+        async def post_image(session, name, data):
+            if name == "broken.png":
+                return 400, "Error uploading"
+            return 200, "ok"
+
+        mock_post_image.side_effect = post_image
+
+        test_image_data = base64.b64encode(b"Test Image Data").decode("utf-8")
+        images = [
+            {"name": "first.png", "image": test_image_data},
+            {"name": "broken.png", "image": test_image_data},
+            {"name": "third.png", "image": test_image_data},
+        ]
+
+        responses = await rp_handler.upload_images(MagicMock(), images)
+
+        self.assertEqual(mock_post_image.await_count, 3)
+        self.assertEqual(responses["status"], "error")
+        self.assertEqual(
+            responses["details"], ["Error uploading broken.png: Error uploading"]
+        )